@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Measure the import time of the package and its modules.
+
+Each import is timed in a fresh interpreter, and the median of several runs
+is reported, along with the heavy dependencies the import pulled in.
+
+$ python3 benchmarks/import_time.py
+"""
+
+###############################################################################
+# Module Imports
+###############################################################################
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+###############################################################################
+
+MODULES = [
+    'pyscp_ebooks', 'pyscp_ebooks.cache', 'pyscp_ebooks.runner',
+    'pyscp_ebooks.daemon', 'pyscp_ebooks.epub', 'pyscp_ebooks.scp_wiki',
+    'pyscp_ebooks.wanderers_library']
+HEAVY = ['bs4', 'lxml', 'arrow']
+
+SCRIPT = """
+import sys, time
+started = time.perf_counter()
+import {}
+elapsed = time.perf_counter() - started
+print(elapsed, ','.join(m for m in {!r} if m in sys.modules))
+"""
+
+###############################################################################
+
+
+def measure(module, runs):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    times = []
+    for _ in range(runs):
+        output = subprocess.check_output(
+            [sys.executable, '-c', SCRIPT.format(module, HEAVY)],
+            cwd=root).decode('UTF-8').split()
+        times.append(float(output[0]))
+    heavy = output[1] if len(output) > 1 else '-'
+    return statistics.median(times), heavy
+
+
+def main():
+    cli = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    cli.add_argument('--runs', type=int, default=10)
+    args = cli.parse_args()
+    for module in MODULES:
+        elapsed, heavy = measure(module, args.runs)
+        print('{:32} {:>8.1f} ms   {}'.format(module, elapsed * 1000, heavy))
+
+
+if __name__ == '__main__':
+    main()
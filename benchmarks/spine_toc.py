@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Measure the time and memory needed to write content.opf and toc.ncx.
+
+Builds the page tree of a large book, with sections of 100 pages each, and
+times the writing of both documents, reporting the peak memory allocated
+while doing so.
+
+$ python3 benchmarks/spine_toc.py --pages 50000
+"""
+
+###############################################################################
+# Module Imports
+###############################################################################
+
+import argparse
+import itertools
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pyscp_ebooks import epub  # noqa
+
+###############################################################################
+
+
+def make_book(pages, section_size=100):
+    book = epub.Book(title='Benchmark', reproducible=True)
+    uids = map('{:05}'.format, itertools.count(1))
+    for start in range(0, pages, section_size):
+        section = epub.Page(next(uids), 'Section {}'.format(start), [])
+        book.root.append(section)
+        for i in range(start, min(start + section_size, pages)):
+            section.children.append(
+                epub.Page(next(uids), 'Page & <{}>'.format(i), []))
+    return book
+
+
+def measure(function):
+    # tracing allocations slows everything down, so time a separate run
+    started = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - started
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    cli = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    cli.add_argument('--pages', type=int, default=50000)
+    args = cli.parse_args()
+    book = make_book(args.pages)
+    for name in ('_write_spine', '_write_toc'):
+        elapsed, peak = measure(getattr(book, name))
+        print('{:14} {:>8.1f} ms {:>8.1f} MiB'.format(
+            name, elapsed * 1000, peak / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
@@ -1 +1,19 @@
-from pyscp_ebooks import epub, parser, builder, scp_wiki, utils
\ No newline at end of file
+"""
+Create ebooks from wikidot-hosted sites.
+
+Submodules are imported on first access, so that processes which only need
+part of the package don't pay for importing bs4, lxml and arrow.
+"""
+
+import importlib
+
+__all__ = [
+    'epub', 'parser', 'builder', 'cache', 'scp_wiki', 'wanderers_library',
+    'utils', 'runner', 'daemon', 'watchdog']
+
+
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError(
+        'module {!r} has no attribute {!r}'.format(__name__, name))
@@ -6,15 +6,19 @@
 # Module Imports
 ###############################################################################
 
+import collections
 import logging
 
-from . import epub, parser, utils
+from . import epub, parser, utils, watchdog
 
 
 ###############################################################################
 
 log = logging.getLogger(__name__)
 
+# fallbacks lists the url of each page rendered as plain text, and the reason
+Saved = collections.namedtuple('Saved', 'written fallbacks')
+
 ###############################################################################
 
 
@@ -26,13 +30,33 @@ class Book:
     This class provides common functionality for turning wikidot websites
     into epub ebooks. This includes html parsing, placing and overwriting
     placeholder pages, and constructing credits.
+
+    If page_timeout is given, each page is rendered in an isolated worker
+    process, within page_timeout seconds and using at most page_memory
+    additional bytes. Pages exceeding the budget are rendered as plain text
+    and listed in the fallbacks attribute.
+
+    If max_pages is given, no more than that many parsed pages are kept in
+    memory, on top of the limit of parser.Documents.
+
+    Reproducible books without an explicit date are dated by the most recent
+    edit of the pages they contain.
     """
 
-    def __init__(self, wiki, heap, **kwargs):
+    def __init__(self, wiki, heap, page_timeout=None, page_memory=None,
+                 max_pages=None, **kwargs):
         self.wiki = wiki
         self.heap = {p.url for p in heap}
         self.book = epub.Book(**kwargs)
+        self.documents = parser.Documents(wiki)
+        if max_pages:
+            self.documents.max_size = min(self.documents.max_size, max_pages)
         self.urls = {}
+        self.titles = {}
+        self.page_timeout = page_timeout
+        self.page_memory = page_memory
+        self.fallbacks = []
+        self.edited = []
         self.pb = utils.PBar(
             '{:40.40}'.format(self.book.title.upper()), len(self.heap) * 3)
 
@@ -43,8 +67,10 @@ class Book:
         """
         Add the page at the given url to the ebook.
 
-        Places a placeholder empty page into the ebook.
-        This is later overwritten by the correct data post-parsing.
+        Places a placeholder page into the ebook, titled with the url.
+        The page is rendered right away, from the document parsed while
+        building the structure of the book, and its title and links are
+        filled in once the book is saved.
 
         If the url is not in the heap, silently does nothing.
         """
@@ -54,8 +80,28 @@ class Book:
         self.heap.remove(url)
         page = self.book.add_page(url, '-', parent)
         self.urls[url] = page.uid
+        self._render(url, page.uid)
         return page
 
+    def _render(self, url, uid):
+        page = self.wiki(url)
+        self.titles[url] = page.title
+        edited = parser.edited(page.html)
+        if edited:
+            self.edited.append(edited)
+        if self.page_timeout:
+            # isolated workers parse the page html on their own
+            self.documents.release(url)
+            self.book._write_xhtml(uid, self._render_isolated(page))
+            return
+        document = self.documents.take(url)
+        try:
+            content = self._get_content(page, document)
+        finally:
+            # see parser.Documents.release
+            document.decompose()
+        self.book._write_page(uid, page.title, content)
+
     def _replace_placeholders(self, parent):
         """
         Find and replace placeholders in the page tree.
@@ -67,19 +113,56 @@ class Book:
         for i in parent.children:
             self._replace_placeholders(i)
 
-    def _get_content(self, page):
+    def _get_parser(self):
+        # pages are rendered before all of them are known, see _overwrite
+        return parser.Parser(None)
+
+    def _get_content(self, page, document=None):
         if not hasattr(self, '_parser'):
-            self._parser = parser.Parser(self.urls)
-        return self._parser.parse(page)
+            self._parser = self._get_parser()
+        return self._parser.parse(page, document)
+
+    def _render_isolated(self, page):
+        if not hasattr(self, '_watchdog'):
+            self._watchdog = watchdog.Watchdog(
+                self._get_parser(), self.page_timeout, self.page_memory)
+        return self._watchdog.render(page)
 
     def _overwrite(self, item):
-        """Overwrite the placeholder page with parsed data."""
+        """
+        Finish the placeholder page.
+
+        Resolves the links of the already rendered page, now that all pages
+        of the book are known, and replaces the url with the page title.
+        """
         if item.title not in self.urls:
             return item
         self.pb.update()
-        page = self.wiki(item.title)
-        self.book._write_page(item.uid, page.title, self._get_content(page))
-        return item._replace(title=page.title)
+        path = self.book.path / 'pages' / (item.uid + '.xhtml')
+        with open(str(path), 'rb') as file:
+            data = file.read()
+        resolved = parser.resolve_links(data, self.urls)
+        if resolved != data:
+            self.book._write_xhtml(item.uid, resolved)
+        return item._replace(title=self.titles[item.title])
+
+    def add_license(self, html):
+        """
+        Add the license page.
+
+        The page is written when the book is saved, with the date of the book
+        in the element of the footer class, since the date of a reproducible
+        book depends on the pages in it.
+        """
+        self._license = self.add_page('License', '-'), html
+        return self._license[0]
+
+    def _write_license(self):
+        page, html = self._license
+        license = parser.bs(html)
+        license.find(class_='footer').string = self.book.date.format(
+            'YYYY-MM-DD')
+        self.book._write_page(page.uid, page.title, license.div.prettify())
 
     def _add_section_header(self, title, parent=None):
         """Add an empty page with the title of the new section"""
@@ -141,7 +224,31 @@ class Book:
         return '<p>{}.</p>'.format(source)
 
     def save(self, filename):
+        """
+        Save the book, returning a Saved tuple.
+
+        Its written field is True if the file was written; see epub.Book.save
+        for when reproducible books are not. Its fallbacks field is the same
+        as the fallbacks attribute.
+        """
         for page in self.book.root:
             self._replace_placeholders(page)
-        self.book.save(filename)
+        if hasattr(self, '_watchdog'):
+            self._watchdog.close()
+            self.fallbacks = self._watchdog.failed
+        if self.book.date is None:
+            import arrow
+            self.book.date = (
+                arrow.get(max(self.edited)) if self.edited
+                else arrow.Arrow(*epub.ZIP_EPOCH))
+        if hasattr(self, '_license'):
+            self._write_license()
+        written = self.book.save(filename)
         self.pb.finish()
+        log.info('Peak memory: {:.1f} MiB'.format(
+            utils.peak_memory() / 2 ** 20))
+        if self.fallbacks:
+            log.warning('Pages rendered as plain text in {}:\n{}'.format(
+                self.book.title,
+                '\n'.join('{} ({})'.format(*i) for i in self.fallbacks)))
+        return Saved(written, self.fallbacks)
@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+"""
+Persistent caching of wiki listings and images.
+
+Listing queries (list_pages and list_images) are the most expensive requests
+made while building a book, and their results rarely change between builds
+that start a few minutes apart. CachedWiki wraps a wiki object and stores
+the results of these queries on disk, keyed by the query parameters, so that
+back-to-back builds can share a single fetch. ImageStore does the same for
+the image files included in the books.
+
+Example usage:
+
+>>> wiki = CachedWiki(pyscp.wikidot.Wiki('scp-wiki'), '/tmp/listings')
+>>> images = ImageStore('/tmp/images')
+>>> scp_wiki.build_complete(wiki, '/tmp/books/', image_store=images)
+
+"""
+
+###############################################################################
+# Module Imports
+###############################################################################
+
+import collections
+import contextlib
+import hashlib
+import io
+import json
+import logging
+import os
+import pathlib
+import tempfile
+import threading
+import time
+
+###############################################################################
+
+log = logging.getLogger(__name__)
+
+###############################################################################
+
+Record = collections.namedtuple('Record', 'pages listings')
+
+
+class Image:
+
+    """
+    Cached image listing record.
+
+    Mirrors the attributes of the wiki image objects used by the builders.
+    The image data is not part of the listing, and is downloaded anew on
+    every access instead of being kept in memory; ImageStore keeps it on
+    disk instead. Downloads taking longer than timeout seconds to respond
+    raise an error instead of stalling the build.
+    """
+
+    timeout = 60
+
+    def __init__(self, url, source, status):
+        self.url = url
+        self.source = source
+        self.status = status
+
+    @property
+    def data(self):
+        with self.open() as response:
+            return response.read()
+
+    def open(self):
+        """Return a binary stream of the image data, without keeping it."""
+        # urllib.request imports most of http and ssl; most processes using
+        # the cache never download anything
+        import urllib.request
+        return urllib.request.urlopen(self.url, timeout=self.timeout)
+
+
+class CachedWiki:
+
+    """
+    Wiki wrapper with an on-disk ttl cache of the listing queries.
+
+    Each query is stored in a separate json file in the cache directory.
+    Entries older than ttl seconds are refetched, and the least recently
+    written entries are evicted once there are more than max_entries of them.
+    If refresh is True, every query is refetched once per instance,
+    regardless of the cached entries. If path is None, listings are only
+    kept in memory.
+
+    Page objects accessed by calling the instance are shared between all its
+    callers, so that books built from one CachedWiki fetch each page once;
+    pages returned by list_pages are only shared if already cached. At most
+    max_pages page objects, and max_entries listings, are kept in memory;
+    the least recently used ones are dropped first. All other attributes
+    are passed through to the wrapped wiki.
+    """
+
+    def __init__(
+            self, wiki, path=None, ttl=3600, max_entries=256, refresh=False,
+            max_pages=None):
+        self.wiki = wiki
+        self.path = path and pathlib.Path(path).expanduser()
+        if self.path:
+            self.path.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.refresh = refresh
+        self.max_pages = max_pages
+        self._memory = collections.OrderedDict()
+        self._pages = collections.OrderedDict()
+        self._fetching = {}
+        self._lock = threading.RLock()
+        self._local = threading.local()
+
+    def __call__(self, url):
+        for record in getattr(self._local, 'records', []):
+            record.pages.add(url)
+        return self._page(url)
+
+    def __getattr__(self, name):
+        return getattr(self.wiki, name)
+
+    ###########################################################################
+
+    def list_pages(self, **kwargs):
+        urls = self._get(
+            'list_pages', kwargs,
+            lambda: [p.url for p in self.wiki.list_pages(**kwargs)])
+        # listings are mostly used for their urls; their pages only enter
+        # the cache once they're accessed, so that a large listing doesn't
+        # evict the pages actually in use
+        with self._lock:
+            return [self._pages.get(url) or self.wiki(url) for url in urls]
+
+    def list_images(self, **kwargs):
+        records = self._get(
+            'list_images', kwargs,
+            lambda: [[i.url, i.source, i.status]
+                     for i in self.wiki.list_images(**kwargs)])
+        return [Image(*i) for i in records]
+
+    def clear(self):
+        """Remove all cached entries."""
+        self._memory.clear()
+        if not self.path:
+            return
+        for file in self.path.glob('*.json'):
+            file.unlink()
+
+    def invalidate(self, urls):
+        """Drop the page objects for the urls, forcing them to be refetched."""
+        with self._lock:
+            for url in urls:
+                self._pages.pop(url, None)
+
+    @contextlib.contextmanager
+    def record(self):
+        """
+        Record the inputs used in the current thread.
+
+        Yields a Record, which is filled with the urls of the pages accessed
+        by calling the wiki and the listing queries made while the context
+        is active.
+        """
+        record = Record(set(), set())
+        if not hasattr(self._local, 'records'):
+            self._local.records = []
+        self._local.records.append(record)
+        try:
+            yield record
+        finally:
+            self._local.records.remove(record)
+
+    def bind(self, function):
+        """
+        Return the function, recording its inputs in the current records.
+
+        The records of the calling thread are made active in whichever
+        thread the returned function is run, so that work handed off to
+        other threads is recorded as well.
+        """
+        records = list(getattr(self._local, 'records', []))
+
+        def bound(*args, **kwargs):
+            previous = getattr(self._local, 'records', [])
+            self._local.records = previous + records
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self._local.records = previous
+        return bound
+
+    def listing(self, method, params):
+        """Return the cached result of a recorded listing query."""
+        return getattr(self, method)(**dict(params))
+
+    ###########################################################################
+
+    def _page(self, url):
+        with self._lock:
+            if url in self._pages:
+                self._pages.move_to_end(url)
+            else:
+                self._pages[url] = self.wiki(url)
+                while self.max_pages and len(self._pages) > self.max_pages:
+                    self._pages.popitem(last=False)
+            return self._pages[url]
+
+    def _key(self, method, params):
+        query = json.dumps([method, params], sort_keys=True)
+        return hashlib.sha1(query.encode('UTF-8')).hexdigest()
+
+    def _get(self, method, params, fetch):
+        for record in getattr(self._local, 'records', []):
+            record.listings.add((method, tuple(sorted(params.items()))))
+        key = self._key(method, params)
+        # concurrent builds sharing this instance wait for the first fetch
+        # of the same query instead of repeating it; other queries and page
+        # accesses go on in the meantime
+        with self._lock:
+            lock = self._fetching.setdefault(key, threading.Lock())
+        with lock:
+            entry = self._memory.get(key)
+            if entry is None or time.time() - entry['created'] > self.ttl:
+                entry = None if self.refresh else self._load(key)
+                if entry is None:
+                    log.info('Fetching listing: {} {}'.format(method, params))
+                    entry = dict(
+                        method=method, params=params,
+                        created=time.time(), result=fetch())
+                    self._store(key, entry)
+            self._remember(key, entry)
+            return entry['result']
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._memory[key] = entry
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                evicted, _ = self._memory.popitem(last=False)
+                lock = self._fetching.get(evicted)
+                if lock is not None and not lock.locked():
+                    del self._fetching[evicted]
+
+    def _load(self, key):
+        if not self.path:
+            return None
+        file = self.path / (key + '.json')
+        try:
+            with open(str(file)) as stream:
+                entry = json.load(stream)
+        except (OSError, ValueError):
+            return None
+        if time.time() - entry['created'] > self.ttl:
+            return None
+        log.info('Cached listing: {} {}'.format(
+            entry['method'], entry['params']))
+        return entry
+
+    def _store(self, key, entry):
+        if not self.path:
+            return
+        # write to a temporary file first, so that concurrent builds never
+        # see a partially written entry
+        fd, tmp = tempfile.mkstemp(dir=str(self.path), suffix='.tmp')
+        with os.fdopen(fd, 'w') as stream:
+            json.dump(entry, stream)
+        os.replace(tmp, str(self.path / (key + '.json')))
+        self._evict()
+
+    def _evict(self):
+        now = time.time()
+        files = []
+        for file in self.path.glob('*.json'):
+            try:
+                files.append((file.stat().st_mtime, file))
+            except FileNotFoundError:
+                pass  # removed by a concurrent build
+        files.sort()
+        expired = [f for m, f in files if now - m > self.ttl]
+        excess = [f for m, f in files[:max(0, len(files) - self.max_entries)]]
+        for file in set(expired) | set(excess):
+            try:
+                file.unlink()
+            except FileNotFoundError:
+                pass
+
+
+class ImageStore:
+
+    """
+    Persistent content-addressed store of image files.
+
+    Images are stored once per distinct content, in a file named after the
+    sha256 hash of the data, and looked up by their source url through small
+    pointer files. The store can be shared by concurrent builder processes:
+    every file is written to a temporary file and atomically renamed into
+    place.
+
+    Once the stored images take up more than max_size bytes, the least
+    recently used ones are evicted. Images used within the last min_age
+    seconds are never evicted, so that a path returned by get stays valid
+    long enough to be linked into a book.
+    """
+
+    def __init__(self, path, max_size=2 ** 30, min_age=3600):
+        self.path = pathlib.Path(path).expanduser()
+        (self.path / 'objects').mkdir(parents=True, exist_ok=True)
+        (self.path / 'urls').mkdir(exist_ok=True)
+        self.max_size = max_size
+        self.min_age = min_age
+        self._lock = threading.Lock()
+        with self._lock:
+            self._evict()
+
+    def get(self, url, fetch):
+        """
+        Return the path of the stored image from the url.
+
+        If the image isn't stored yet, fetch is called without arguments,
+        and should return either bytes or a binary file-like object.
+        """
+        pointer = self.path / 'urls' / hashlib.sha1(
+            url.encode('UTF-8')).hexdigest()
+        try:
+            with open(str(pointer)) as file:
+                path = self.path / 'objects' / file.read().strip()
+            os.utime(str(path))
+            return path
+        except OSError:
+            pass
+        log.info('Storing image: {}'.format(url))
+        path = self._store(fetch())
+        self._write(pointer, path.name.encode('UTF-8'))
+        return path
+
+    def path_of(self, digest):
+        """Return the path of the image with the given sha256 digest."""
+        path = self.path / 'objects' / digest
+        return path if path.exists() else None
+
+    ###########################################################################
+
+    def _objects(self):
+        return (f for f in (self.path / 'objects').iterdir()
+                if not f.name.endswith('.tmp'))
+
+    def _write(self, path, data):
+        fd, tmp = tempfile.mkstemp(dir=str(path.parent), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        os.replace(tmp, str(path))
+
+    def _store(self, data):
+        fd, tmp = tempfile.mkstemp(
+            dir=str(self.path / 'objects'), suffix='.tmp')
+        digest = hashlib.sha256()
+        size = 0
+        with os.fdopen(fd, 'wb') as file:
+            if isinstance(data, bytes):
+                data = io.BytesIO(data)
+            with data:
+                for chunk in iter(lambda: data.read(2 ** 16), b''):
+                    digest.update(chunk)
+                    file.write(chunk)
+                    size += len(chunk)
+        path = self.path / 'objects' / digest.hexdigest()
+        # identical content written concurrently ends up in the same file
+        os.replace(tmp, str(path))
+        with self._lock:
+            self._size += size
+            if self._size > self.max_size:
+                self._evict()
+        return path
+
+    def _evict(self):
+        now = time.time()
+        files = []
+        for file in self._objects():
+            try:
+                stat = file.stat()
+            except FileNotFoundError:
+                continue  # evicted by a concurrent process
+            files.append((stat.st_mtime, stat.st_size, file))
+        files.sort()
+        self._size = sum(size for mtime, size, file in files)
+        for mtime, size, file in files:
+            if self._size <= self.max_size or now - mtime < self.min_age:
+                break
+            try:
+                file.unlink()
+            except FileNotFoundError:
+                pass
+            self._size -= size
+        # pointers to evicted images would otherwise pile up forever
+        for pointer in (self.path / 'urls').iterdir():
+            if pointer.name.endswith('.tmp'):
+                continue
+            try:
+                with open(str(pointer)) as file:
+                    digest = file.read().strip()
+                if not (self.path / 'objects' / digest).exists():
+                    pointer.unlink()
+            except FileNotFoundError:
+                pass  # removed by a concurrent process
@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+"""
+Long-running build daemon.
+
+The daemon keeps the wiki wrappers, and with them the page objects and
+listing queries, warm in memory between builds. Builds are triggered either
+periodically or by commands sent over a local unix socket, and only the
+editions whose input pages changed since their last build are rebuilt.
+
+Supported commands:
+
+    check               rebuild the editions whose inputs have changed
+    build [EDITION...]  unconditionally rebuild the editions (default: all)
+    status              print the last build of each edition
+    stop                shut the daemon down
+
+Example usage:
+
+$ python3 -m pyscp_ebooks.daemon serve /tmp/books/ --interval 86400
+$ python3 -m pyscp_ebooks.daemon send build scp-digest
+
+"""
+
+###############################################################################
+# Module Imports
+###############################################################################
+
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import re
+import socket
+import socketserver
+import threading
+
+from . import cache, runner
+
+###############################################################################
+
+log = logging.getLogger(__name__)
+
+###############################################################################
+
+
+def _signature(page):
+    """Hash the page html, ignoring the current rating of the page."""
+    html = re.sub(r'<span class="number prw\d+">[^<]*</span>', '', page.html)
+    return hashlib.sha1(html.encode('UTF-8')).hexdigest()
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        command = self.rfile.readline().decode('UTF-8').split()
+        try:
+            response = self.server.daemon.execute(command)
+        except Exception as error:
+            log.exception('Command failed: {}'.format(command))
+            response = 'error: {}'.format(error)
+        self.wfile.write((response + '\n').encode('UTF-8'))
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    daemon_threads = True
+
+
+class Daemon:
+
+    """
+    Rebuild ebook editions on a schedule or on request.
+
+    The wikis argument maps site names to wiki objects, the same as in
+    runner.build. Each wiki is wrapped in a CachedWiki that holds at most
+    max_pages page objects, and max_pages is passed on to the build
+    functions as well.
+
+    The inputs of each edition are recorded while it is built. An edition
+    is considered changed if the results of its listing queries, the html of
+    any page it accessed, or its period (see runner.Edition) differ from
+    those seen during the previous build.
+
+    Any options are passed on to the build functions.
+    """
+
+    def __init__(self, wikis, output_path, editions=None, interval=3600,
+                 max_pages=20000, workers=16, **options):
+        self.wikis = {}
+        for site, wiki in wikis.items():
+            if not isinstance(wiki, cache.CachedWiki):
+                wiki = cache.CachedWiki(wiki, max_pages=max_pages)
+            self.wikis[site] = wiki
+        self.output_path = output_path
+        self.editions = list(editions or runner.EDITIONS)
+        self.interval = interval
+        self.workers = workers
+        self.options = dict(options, max_pages=max_pages)
+        self.state = {}
+        self._build_lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    ###########################################################################
+
+    def _signatures(self, site, urls, refetch=False):
+        """
+        Return the signatures of the pages of the site, keyed by url.
+
+        If refetch is True, the pages are dropped from the cache and fetched
+        again, otherwise the already loaded page objects are used.
+        """
+        wiki = self.wikis[site]
+        urls = sorted(urls)
+        if refetch:
+            wiki.invalidate(urls)
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+            signatures = executor.map(lambda x: _signature(wiki(x)), urls)
+            return dict(zip(urls, signatures))
+
+    def _fingerprint(self, name, inputs, signatures):
+        """Hash the current state of the inputs of the edition."""
+        edition = runner.EDITIONS[name]
+        wiki = self.wikis[edition.site]
+        digest = hashlib.sha1()
+        if edition.period:
+            digest.update(edition.period().encode('UTF-8'))
+        for method, params in sorted(inputs.listings):
+            urls = sorted(i.url for i in wiki.listing(method, params))
+            digest.update(json.dumps([method, params, urls]).encode('UTF-8'))
+        for url in sorted(inputs.pages):
+            digest.update('{} {}'.format(url, signatures[url]).encode('UTF-8'))
+        return digest.hexdigest()
+
+    def _fingerprints(self, inputs, refetch=False):
+        """
+        Hash the inputs of several editions, keyed by edition name.
+
+        Editions of the same site share most of their pages, so the union of
+        their pages is signed once per site, and each edition is hashed from
+        those signatures.
+        """
+        signatures = {}
+        for site in {runner.EDITIONS[n].site for n in inputs}:
+            urls = set().union(*(
+                i.pages for n, i in inputs.items()
+                if runner.EDITIONS[n].site == site))
+            signatures.update(self._signatures(site, urls, refetch))
+        return {
+            name: self._fingerprint(name, i, signatures)
+            for name, i in inputs.items()}
+
+    def changed(self, names=None):
+        """Return the names of the editions that need to be rebuilt."""
+        names = list(names or self.editions)
+        inputs = {
+            name: self.state[name][1].inputs
+            for name in names if name in self.state}
+        fingerprints = self._fingerprints(inputs, True)
+        return [
+            name for name in names if name not in self.state
+            or fingerprints[name] != self.state[name][0]]
+
+    def build(self, names=None, force=False):
+        """
+        Build the editions, returning their summaries.
+
+        Unless force is True, editions whose inputs haven't changed since
+        their last build are skipped.
+        """
+        with self._build_lock:
+            names = list(names or self.editions)
+            if not force:
+                names = self.changed(names)
+            if not names:
+                log.info('No changes, nothing to rebuild.')
+                return []
+            summaries = runner.build(
+                names, self.wikis, self.output_path, self.workers,
+                **self.options)
+            fingerprints = self._fingerprints(
+                {s.name: s.inputs for s in summaries if not s.error})
+            for summary in summaries:
+                # failed editions are forgotten, so that the next check
+                # tries to build them again
+                if summary.error:
+                    self.state.pop(summary.name, None)
+                    continue
+                self.state[summary.name] = (
+                    fingerprints[summary.name], summary)
+            return summaries
+
+    def execute(self, command):
+        """Execute a socket command and return the text of the response."""
+        if not command:
+            return 'error: empty command'
+        name, args = command[0], command[1:]
+        for edition in args:
+            if edition not in runner.EDITIONS:
+                return 'error: unknown edition: {}'.format(edition)
+        if name == 'check':
+            summaries = self.build()
+        elif name == 'build':
+            summaries = self.build(args, force=True)
+        elif name == 'status':
+            summaries = [s for f, s in self.state.values()]
+        elif name == 'stop':
+            self.stop()
+            return 'stopping'
+        else:
+            return 'error: unknown command: {}'.format(name)
+        lines = []
+        for s in summaries:
+            if s.error:
+                lines.append('{} failed: {}'.format(s.name, s.error))
+                continue
+            lines.append(
+                '{} {:.0f}s {} bytes, {} of {} file(s) written'.format(
+                    s.name, s.seconds, s.size, len(s.written),
+                    len(s.filenames)))
+            lines.extend(
+                '    rendered as plain text: {} ({})'.format(*i)
+                for i in s.fallbacks)
+        return '\n'.join(lines) or 'nothing to do'
+
+    ###########################################################################
+
+    def _schedule(self):
+        while not self._stopped.is_set():
+            try:
+                self.build()
+            except Exception:
+                log.exception('Scheduled build failed.')
+            self._stopped.wait(self.interval)
+
+    def serve(self, socket_path):
+        """Serve commands on the unix socket until stopped."""
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        self._server = _Server(socket_path, _Handler)
+        self._server.daemon = self
+        threading.Thread(target=self._schedule, daemon=True).start()
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            os.remove(socket_path)
+
+    def stop(self):
+        self._stopped.set()
+        # shutdown blocks until serve_forever returns, which can't happen
+        # while this handler thread is waiting on it
+        threading.Thread(target=self._server.shutdown).start()
+
+
+def send(socket_path, command):
+    """Send a command to a running daemon and return the response."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socket_path)
+        connection.sendall((' '.join(command) + '\n').encode('UTF-8'))
+        response = b''
+        while True:
+            chunk = connection.recv(4096)
+            if not chunk:
+                break
+            response += chunk
+    return response.decode('UTF-8').rstrip('\n')
+
+###############################################################################
+
+
+def main():
+    cli = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    cli.add_argument(
+        '--socket', default=os.path.expanduser('~/.pyscp_ebooks.sock'))
+    commands = cli.add_subparsers(dest='command')
+    serve = commands.add_parser('serve')
+    serve.add_argument('output_path')
+    serve.add_argument('editions', nargs='*', default=list(runner.EDITIONS))
+    serve.add_argument('--interval', type=int, default=86400)
+    serve.add_argument('--ttl', type=int, default=3600)
+    serve.add_argument('--max-pages', type=int, default=20000)
+    serve.add_argument('--images')
+    serve.add_argument('--images-size', type=int, default=1024)
+    serve.add_argument('--reproducible', action='store_true')
+    send_ = commands.add_parser('send')
+    send_.add_argument('args', nargs='+')
+    args = cli.parse_args()
+    if args.command == 'send':
+        print(send(args.socket, args.args))
+    elif args.command == 'serve':
+        import pyscp.wikidot
+        wikis = {
+            site: cache.CachedWiki(
+                pyscp.wikidot.Wiki(site), ttl=args.ttl,
+                max_pages=args.max_pages)
+            for site in {runner.EDITIONS[n].site for n in args.editions}}
+        options = {}
+        if args.images:
+            options['image_store'] = cache.ImageStore(
+                args.images, args.images_size * 2 ** 20)
+        if args.reproducible:
+            options['reproducible'] = True
+        Daemon(
+            wikis, args.output_path, args.editions, args.interval,
+            args.max_pages, **options).serve(args.socket)
+    else:
+        cli.print_help()
+
+
+if __name__ == '__main__':
+    main()
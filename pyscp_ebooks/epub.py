@@ -29,14 +29,16 @@ Example usage:
 # Module Imports
 ###############################################################################
 
-import arrow
 import collections
+import hashlib
 import itertools
 import logging
-import lxml.etree
-import lxml.html
+import mmap
+import os
 import pathlib
 import pkgutil
+import re
+import shutil
 import tempfile
 import uuid
 import zipfile
@@ -45,6 +47,13 @@ import zipfile
 
 log = logging.getLogger(__name__)
 
+# lxml and arrow are imported by the functions using them, so that modules
+# planning or inspecting books don't pay for them, see
+# benchmarks/import_time.py
+
+# earliest timestamp representable in a zip archive
+ZIP_EPOCH = (1980, 1, 1, 0, 0, 0)
+
 ###############################################################################
 
 
@@ -52,6 +61,7 @@ class ETreeWrapper:
     """Convinience wrapper around xml trees."""
 
     def __init__(self, *args, namespaces, **kwargs):
+        import lxml.etree
         self.tree = lxml.etree.ElementTree(*args, **kwargs)
         self.namespaces = namespaces
 
@@ -68,9 +78,16 @@ class ETreeWrapper:
         self.tree.write(str(path), xml_declaration=True,
                         encoding='UTF-8', pretty_print=True)
 
+    def tostring(self):
+        import lxml.etree
+        return lxml.etree.tostring(
+            self.tree, xml_declaration=True,
+            encoding='UTF-8', pretty_print=True)
+
 
 def template(name):
     """Get file template."""
+    import lxml.etree
     return ETreeWrapper(
         lxml.etree.fromstring(
             pkgutil.get_data('pyscp_ebooks', 'resources/templates/' + name),
@@ -82,11 +99,114 @@ def template(name):
             ncx='http://www.daisy.org/z3986/2005/ncx/'))
 
 
+def render_page(title, content):
+    """Render the title and html content of a page into an xhtml file."""
+    import lxml.html
+    xmltree = template('page.xhtml')
+    xmltree('xhtml:title').text = title
+    xmltree('xhtml:body').append(lxml.html.fromstring(content))
+    return xmltree.tostring()
+
+
 def flatten(tree):
     for item in tree:
         yield item
         yield from flatten(item.children)
 
+
+def archive_hash(filename):
+    """
+    Return the content hash of an existing epub file.
+
+    The hash matches Book.content_hash for a book saved to the file.
+    Returns None if the file doesn't exist or isn't a valid archive.
+    """
+    digest = hashlib.sha256()
+    try:
+        with zipfile.ZipFile(filename) as archive:
+            for name in archive.namelist():
+                digest.update(name.encode('UTF-8') + b'\0')
+                with archive.open(name) as file:
+                    for chunk in iter(lambda: file.read(2 ** 16), b''):
+                        digest.update(chunk)
+    except (OSError, zipfile.BadZipFile):
+        return None
+    return digest.hexdigest()
+
+###############################################################################
+# Streaming Helpers
+###############################################################################
+
+# placeholder marking where the streamed entries go in a template
+STREAM = 'stream'
+_INVALID = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+def _escape(value, entities):
+    if _INVALID.search(value):
+        raise ValueError(
+            'All strings must be XML compatible: Unicode or ASCII, '
+            'no NULL bytes or control characters')
+    for char, entity in entities:
+        if char in value:
+            value = value.replace(char, entity)
+    return value
+
+
+def _text(value):
+    """Escape text the same way lxml does."""
+    return _escape(value, (
+        ('&', '&amp;'), ('<', '&lt;'), ('>', '&gt;'), ('\r', '&#13;')))
+
+
+def _attribute(value):
+    """Escape an attribute value the same way lxml does."""
+    return _escape(value, (
+        ('&', '&amp;'), ('<', '&lt;'), ('>', '&gt;'), ('"', '&quot;'),
+        ('\n', '&#10;'), ('\r', '&#13;'), ('\t', '&#9;')))
+
+
+def _line(level, line, *args):
+    """Format a pretty-printed line of xml at the given nesting level."""
+    return ('  ' * level + line.format(*args) + '\n').encode('UTF-8')
+
+
+def _split_template(tree, level):
+    """
+    Serialize the template and split it at the STREAM placeholders.
+
+    The placeholders must be at the given nesting level. Returns an
+    iterator over the parts of the serialized template.
+    """
+    placeholder = _line(level, '<!--{}-->', STREAM)
+    return iter(tree.tostring().split(placeholder))
+
+
+def _toc_lines(pages, level):
+    """Yield the lines of the navPoints of the pages and all their children."""
+    stack = [(iter(pages), level)]
+    while stack:
+        children, level = stack[-1]
+        page = next(children, None)
+        if page is None:
+            stack.pop()
+            if stack:
+                yield _line(level - 1, '</navPoint>')
+            continue
+        if page.title is None:
+            text = '<text/>'
+        else:
+            text = '<text>{}</text>'.format(_text(page.title))
+        yield (
+            '{0}<navPoint id="{1}" playOrder="{2}">\n'
+            '{0}  <navLabel>\n'
+            '{0}    {3}\n'
+            '{0}  </navLabel>\n'
+            '{0}  <content src="pages/{1}.xhtml"/>\n'.format(
+                '  ' * level, page.uid, page.uid.lstrip('0'), text)
+            .encode('UTF-8'))
+        stack.append((iter(page.children), level + 1))
+
 ###############################################################################
 
 Page = collections.namedtuple('Page', 'uid title children')
@@ -97,6 +217,7 @@ class Book:
     """Wrapper around a epub archive."""
 
     def __init__(self, **kwargs):
+        import arrow
         self.tempdir = tempfile.TemporaryDirectory()
         self.root = []
         self.images = []
@@ -110,6 +231,22 @@ class Book:
         self.language = kwargs.get('language', 'en')
         self.author = kwargs.get('author', 'Unknown Author')
 
+        # reproducible books are byte-for-byte identical if their content is
+        # the same; following the reproducible-builds convention, this is the
+        # default whenever SOURCE_DATE_EPOCH is set
+        self.reproducible = kwargs.get(
+            'reproducible', 'SOURCE_DATE_EPOCH' in os.environ)
+        if kwargs.get('date'):
+            self.date = arrow.get(kwargs['date'])
+        elif not self.reproducible:
+            self.date = arrow.utcnow()
+        elif 'SOURCE_DATE_EPOCH' in os.environ:
+            self.date = arrow.get(int(os.environ['SOURCE_DATE_EPOCH']))
+        else:
+            # left for the caller to derive from the content; books saved
+            # without a date are dated at the zip epoch
+            self.date = None
+
     def add_page(self, title, content, parent=None):
         """
         Add a new page.
@@ -125,20 +262,45 @@ class Book:
 
     def _write_page(self, uid, title, content):
         """Write the contents of the page into an xhtml file."""
-        xmltree = template('page.xhtml')
-        xmltree('xhtml:title').text = title
-        xmltree('xhtml:body').append(lxml.html.fromstring(content))
-        xmltree.write(self.path / 'pages' / (uid + '.xhtml'))
+        self._write_xhtml(uid, render_page(title, content))
+
+    def _write_xhtml(self, uid, data):
+        """Write an already rendered xhtml file of the page."""
+        with open(str(self.path / 'pages' / (uid + '.xhtml')), 'wb') as file:
+            file.write(data)
 
     def add_image(self, name, data):
+        """
+        Add a new image.
+
+        The data can be bytes, a binary file-like object, which is copied to
+        the book in chunks and closed afterwards, or the pathlib.Path of an
+        image file, which is hard-linked into the book when possible. An
+        image file that is already in the book is left as it is.
+        """
         log.info('New image: {}'.format(name))
         if name.endswith('.jpg'):
             media_type = 'image/jpeg'
         if name.endswith('.png'):
             media_type = 'image/png'
+        target = self.path / 'images' / name
+        if isinstance(data, pathlib.Path) and target.exists():
+            return
         self.images.append(Image(name, media_type))
-        with open(str(self.path / 'images' / name), 'wb') as file:
-            file.write(data)
+        if isinstance(data, pathlib.Path):
+            try:
+                os.link(str(data), str(target))
+            except FileExistsError:
+                pass
+            except OSError:
+                shutil.copyfile(str(data), str(target))
+            return
+        with open(str(target), 'wb') as file:
+            if isinstance(data, bytes):
+                file.write(data)
+            else:
+                with data:
+                    shutil.copyfileobj(data, file)
 
     def set_cover(self, data):
         """Set the cover image to the given png data."""
@@ -151,48 +313,107 @@ class Book:
             file.write(data)
 
     def save(self, filename):
+        """
+        Save the book to the given file.
+
+        Reproducible books are not written if the file already contains a
+        book with the same content, which leaves the file and its
+        modification time untouched. Returns True if the file was written.
+        """
         self._write_spine()
         self._write_container()
         self._write_toc()
         with open(str(self.path / 'mimetype'), 'w') as file:
             file.write('application/epub+zip')
+        if self.reproducible and self.content_hash() == archive_hash(filename):
+            log.info('Book unchanged: {}'.format(self.title))
+            return False
         with zipfile.ZipFile(filename, 'w') as archive:
-            archive.write(
-                str(self.path / 'mimetype'), 'mimetype',
-                compress_type=zipfile.ZIP_STORED)
-            for file in self.path.rglob('*.*'):
-                archive.write(
-                    str(file), str(file.relative_to(self.path)),
-                    compress_type=zipfile.ZIP_DEFLATED)
+            for name in self._entries():
+                self._archive_file(archive, name)
         log.info('Book saved: {}'.format(self.title))
+        return True
+
+    def _entries(self):
+        """Return the archive names of the book files, mimetype first."""
+        names = sorted(
+            f.relative_to(self.path).as_posix()
+            for f in self.path.rglob('*.*'))
+        return ['mimetype'] + names
+
+    def _archive_file(self, archive, name):
+        # images are already compressed, deflating them again only costs time
+        stored = name == 'mimetype' or name.startswith('images/')
+        compress_type = zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED
+        if not self.reproducible:
+            archive.write(
+                str(self.path / name), name, compress_type=compress_type)
+            return
+        info = zipfile.ZipInfo(name, date_time=ZIP_EPOCH)
+        info.compress_type = compress_type
+        info.external_attr = 0o644 << 16
+        with open(str(self.path / name), 'rb') as file:
+            if not os.fstat(file.fileno()).st_size:
+                archive.writestr(info, b'')
+                return
+            # map the file instead of reading it, so that large images are
+            # written to the archive without being copied into memory first
+            with mmap.mmap(
+                    file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                archive.writestr(info, data)
+
+    def content_hash(self):
+        """Return a hash of the names and contents of the book files."""
+        digest = hashlib.sha256()
+        for name in self._entries():
+            digest.update(name.encode('UTF-8') + b'\0')
+            with open(str(self.path / name), 'rb') as file:
+                for chunk in iter(lambda: file.read(2 ** 16), b''):
+                    digest.update(chunk)
+        return digest.hexdigest()
 
     def _write_spine(self):
+        import arrow
+        import lxml.etree
         spine = template('content.opf')
-        now = arrow.utcnow().format('YYYY-MM-DDTHH:mm:ss')
-        spine(property='dcterms:modified').text = now
-        spine('dc:date').text = now
+        date = self.date or arrow.Arrow(*ZIP_EPOCH)
+        if self.reproducible:
+            modified = date
+            identifier = uuid.uuid5(uuid.NAMESPACE_URL, self.title)
+        else:
+            modified = arrow.utcnow()
+            identifier = uuid.uuid4()
+        spine(property='dcterms:modified').text = modified.format(
+            'YYYY-MM-DDTHH:mm:ss')
+        spine('dc:date').text = date.format('YYYY-MM-DDTHH:mm:ss')
         spine('dc:title').text = self.title
         spine('dc:creator').text = self.author
         spine('dc:language').text = self.language
-        spine(id='uuid_id').text = str(uuid.uuid4())
-
-        for page in flatten(self.root):
-            lxml.etree.SubElement(
-                spine('opf:manifest'), 'item',
-                href='pages/{}.xhtml'.format(page.uid), id=page.uid,
-                **{'media-type': 'application/xhtml+xml'})
-            lxml.etree.SubElement(
-                spine('opf:spine'), 'itemref', idref=page.uid)
-
-        for uid, image in enumerate(self.images):
-            lxml.etree.SubElement(
-                spine('opf:manifest'),
-                'item',
-                href='images/' + image.name,
-                id='img{:03}'.format(uid + 1),
-                **{'media-type': image.type})
-
-        spine.write(self.path / 'content.opf')
+        spine(id='uuid_id').text = str(identifier)
+
+        # the manifest and spine entries are streamed into the file in a
+        # single pass over the pages, instead of being added to the tree
+        spine('opf:manifest').append(lxml.etree.Comment(STREAM))
+        if self.root:
+            spine('opf:spine').append(lxml.etree.Comment(STREAM))
+        parts = _split_template(spine, 2)
+        itemrefs = []
+        with open(str(self.path / 'content.opf'), 'wb') as file:
+            file.write(next(parts))
+            for page in flatten(self.root):
+                file.write(_line(
+                    2, '<item href="pages/{0}.xhtml" id="{0}" '
+                    'media-type="application/xhtml+xml"/>', page.uid))
+                itemrefs.append(_line(2, '<itemref idref="{}"/>', page.uid))
+            for uid, image in enumerate(self.images):
+                file.write(_line(
+                    2, '<item href="images/{}" id="img{:03}" '
+                    'media-type="{}"/>', _attribute(image.name), uid + 1,
+                    _attribute(image.type)))
+            file.write(next(parts))
+            if self.root:
+                file.writelines(itemrefs)
+                file.write(next(parts))
 
     def _write_container(self):
         container = template('container.xml')
@@ -201,18 +422,14 @@ class Book:
         container.write(meta_inf / 'container.xml')
 
     def _write_toc(self):
+        import lxml.etree
         toc = template('toc.ncx')
         toc('ncx:text').text = self.title
-        for page in self.root:
-            self._page_to_toc(page, toc('ncx:navMap'))
-        toc.write(self.path / 'toc.ncx')
-
-    def _page_to_toc(self, page, node):
-        navpoint = lxml.etree.SubElement(
-            node, 'navPoint', id=page.uid, playOrder=page.uid.lstrip('0'))
-        navlabel = lxml.etree.SubElement(navpoint, 'navLabel')
-        lxml.etree.SubElement(navlabel, 'text').text = page.title
-        lxml.etree.SubElement(
-            navpoint, 'content', src='pages/{}.xhtml'.format(page.uid))
-        for child in page.children:
-            self._page_to_toc(child, navpoint)
+        if self.root:
+            toc('ncx:navMap').append(lxml.etree.Comment(STREAM))
+        parts = _split_template(toc, 2)
+        with open(str(self.path / 'toc.ncx'), 'wb') as file:
+            file.write(next(parts))
+            if self.root:
+                file.writelines(_toc_lines(self.root, 2))
+                file.write(next(parts))
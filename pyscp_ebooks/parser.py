@@ -5,14 +5,163 @@
 # Module Imports
 ###############################################################################
 
-import bs4
+import collections
+import html
+import re
+import threading
 
 ###############################################################################
 
 
 def bs(html=''):
+    # imported here rather than at the top, so that importing the site
+    # modules doesn't pull in bs4 and lxml
+    import bs4
     return bs4.BeautifulSoup(html, 'lxml')
 
+
+def absolute(link, site):
+    """Return the absolute url of a link found on the site."""
+    return link if link.startswith(site) else site + link
+
+
+def edited(html):
+    """Return the unix time of the last edit shown in the page html."""
+    match = re.search(
+        r'id="page-info".*?class="odate time_([0-9]+)', html, re.DOTALL)
+    return int(match.group(1)) if match else None
+
+
+_ANCHOR = re.compile(rb'<a( [^>]*?)?(/>|>(.*?)</a>)', re.DOTALL)
+_HREF = re.compile(rb'(?<= )href="([^"]*)"')
+
+
+def resolve_links(xhtml, pages):
+    """
+    Resolve the links in the xhtml of a page rendered without pages.
+
+    Parser leaves the links pointing at their absolute urls if it isn't
+    given the pages of the book. Once the pages are known, links to them are
+    pointed at their xhtml files, and the others are replaced by spans, the
+    same as Parser._link would have done.
+    """
+    def resolve(match):
+        start, end, content = match.groups()
+        href = _HREF.search(start or b'')
+        if href is None:
+            return match.group()
+        url = html.unescape(href.group(1).decode('UTF-8'))
+        if url in pages:
+            start = _HREF.sub(
+                'href="{}.xhtml"'.format(pages[url]).encode('UTF-8'), start)
+            return b'<a' + start + end
+        if end == b'/>':
+            return b'<span class="link"/>'
+        return b'<span class="link">' + content + b'</span>'
+    return _ANCHOR.sub(resolve, xhtml)
+
+###############################################################################
+
+
+class Documents:
+
+    """
+    Parsed html documents of wiki pages, keyed by url.
+
+    Each page is parsed on first access, and the same document is then
+    shared by the structure-building code and the Parser, which takes it
+    over once the page is rendered.
+
+    A parsed document takes many times the memory of its html, so at most
+    max_size documents are kept; the least recently used ones are dropped
+    first, and parsed again if needed. Books render each page as soon as it
+    is added, so documents are only dropped before being rendered if more
+    than max_size pages are parsed in between, such as the links of a hub
+    with very many of them. The links and images of each page are extracted
+    before the document is taken or released, and kept for the lifetime of
+    the instance.
+    """
+
+    max_size = 64
+
+    def __init__(self, wiki, max_size=None):
+        self.wiki = wiki
+        if max_size:
+            self.max_size = max_size
+        self._documents = collections.OrderedDict()
+        self._extracted = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, url):
+        with self._lock:
+            if url in self._documents:
+                self._documents.move_to_end(url)
+                return self._documents[url]
+        # fetch and parse outside of the lock, so that concurrent callers
+        # don't wait on each other's requests
+        document = bs(self.wiki(url).html)
+        with self._lock:
+            document = self._documents.setdefault(url, document)
+            while self.max_size and len(self._documents) > self.max_size:
+                self._documents.popitem(last=False)
+            return document
+
+    def links(self, url):
+        """
+        Return the unique urls of the other pages linked from the page.
+
+        Same as the links attribute of pyscp pages: only relative links are
+        included, and links to images are left out.
+        """
+        return list(self._extract(url)[0])
+
+    def images(self, url):
+        """Return the sources of the images in the page."""
+        return list(self._extract(url)[1])
+
+    def _extract(self, url):
+        with self._lock:
+            if url in self._extracted:
+                return self._extracted[url]
+        document = self(url)
+        links = collections.OrderedDict()
+        for a in document.select('#page-content a'):
+            href = a.get('href')
+            if not href or href[0] != '/' or href[-4:] in (
+                    '.png', '.jpg', '.gif'):
+                continue  # bad or absolute link
+            links[self.wiki.site + href.rstrip('|')] = None
+        images = [i['src'] for i in document('img') if 'src' in i.attrs]
+        with self._lock:
+            return self._extracted.setdefault(url, (list(links), images))
+
+    def take(self, url):
+        """
+        Remove the document of the page and return it, parsing it if needed.
+
+        The document is then owned by the caller, who is free to modify it,
+        and should decompose it once done.
+        """
+        self._extract(url)
+        with self._lock:
+            document = self._documents.pop(url, None)
+        if document is None:
+            document = bs(self.wiki(url).html)
+        return document
+
+    def release(self, url):
+        """Drop the document of the page, if parsed, freeing its memory."""
+        with self._lock:
+            parsed = url in self._documents
+        if parsed:
+            self._extract(url)
+        with self._lock:
+            document = self._documents.pop(url, None)
+        if document is not None:
+            # soups are full of reference cycles; break them right away
+            # instead of waiting for the garbage collector to find them
+            document.decompose()
+
 ###############################################################################
 
 
@@ -24,11 +173,29 @@ class Parser:
     This is a class to allow inheritance by individual epub-builders.
     """
 
+    # page attributes used while parsing, see watchdog.Snapshot
+    attributes = ('url', 'title', 'html')
+
     def __init__(self, pages):
+        """
+        Create a parser for the pages, which map urls to page uids.
+
+        If pages is None, links are left pointing at their absolute urls,
+        and should be resolved with resolve_links once the pages are known.
+        """
         self.pages = pages
 
-    def parse(self, page):
-        soup = bs(page.html).find(id='page-content')
+    def parse(self, page, document=None):
+        """
+        Parse the page into epub-compatible html.
+
+        The document, if given, is the already parsed html of the page. It is
+        modified in place, and shouldn't be used for anything else afterwards.
+        """
+        owned = document is None
+        if owned:
+            document = bs(page.html)
+        soup = document.find(id='page-content')
         for elem in soup(class_='page-rate-widget-box'):
             elem.decompose()
         for elem in soup(class_='yui-navset'):
@@ -46,7 +213,11 @@ class Parser:
         for elem in soup('img'):
             self._image(elem)
         self._title(soup, page)
-        return str(soup)
+        html = str(soup)
+        if owned:
+            # see Documents.release
+            document.decompose()
+        return html
 
     def _tab(self, elem):
         """Parse wikidot tab block."""
@@ -85,10 +256,10 @@ class Parser:
         """Parse a link; remap if links to a page, otherwise remove."""
         if 'href' not in elem.attrs:
             return
-        link = elem['href']
-        if not link.startswith(site):
-            link = site + link
-        if link not in self.pages:
+        link = absolute(elem['href'], site)
+        if self.pages is None:
+            elem['href'] = link
+        elif link not in self.pages:
             elem.name = 'span'
             elem.attrs = {'class': 'link'}
         else:
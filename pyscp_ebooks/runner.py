@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""
+Build several ebook editions in a single run.
+
+All editions built from the same site share one CachedWiki instance, and
+with it the page objects and listing queries. The editions themselves are
+built concurrently, and a summary of the time spent and the size of the
+output is printed once all of them are finished.
+
+Example usage:
+
+$ python3 -m pyscp_ebooks.runner /tmp/books/ scp-tomes scp-digest
+
+"""
+
+###############################################################################
+# Module Imports
+###############################################################################
+
+import argparse
+import collections
+import concurrent.futures
+import importlib
+import logging
+import os
+import time
+
+from . import cache, utils
+
+###############################################################################
+
+log = logging.getLogger(__name__)
+
+###############################################################################
+
+# build returns an ordered mapping of the filenames of the books to the
+# builder.Saved results of saving them; period is an optional callable, and
+# a change in its return value means the edition covers a different set of
+# pages than the previous build did
+Edition = collections.namedtuple('Edition', 'site build period')
+# written lists the filenames that were actually written, leaving out
+# reproducible books that were unchanged; fallbacks lists the url of each
+# page rendered as plain text and the reason; peak is the peak memory of the
+# whole process, which is shared by all the editions built concurrently;
+# error is None if the edition was built, and the error message otherwise
+Summary = collections.namedtuple(
+    'Summary',
+    'name seconds size filenames written fallbacks inputs peak error')
+
+
+def _lazy(module, name):
+    """
+    Return a function calling module.name.
+
+    The site modules are only imported once an edition is actually built,
+    which keeps starting the runner and the daemon cheap.
+    """
+    def function(*args, **kwargs):
+        module_ = importlib.import_module('.' + module, __package__)
+        return getattr(module_, name)(*args, **kwargs)
+    return function
+
+
+EDITIONS = collections.OrderedDict([
+    ('scp-complete', Edition(
+        'www.scp-wiki.net', _lazy('scp_wiki', 'build_complete'), None)),
+    ('scp-tomes', Edition(
+        'www.scp-wiki.net', _lazy('scp_wiki', 'build_tomes'), None)),
+    ('scp-digest', Edition(
+        'www.scp-wiki.net', _lazy('scp_wiki', 'build_digest'),
+        lambda: _lazy('scp_wiki', 'digest_month')().format('YYYY-MM'))),
+    ('wl-complete', Edition(
+        'wanderers-library.wikidot.com',
+        _lazy('wanderers_library', 'build_complete'), None))])
+
+###############################################################################
+
+
+def _build_edition(name, wiki, output_path, options):
+    log.info('Building edition: {}'.format(name))
+    started = time.time()
+    results, error = {}, None
+    with wiki.record() as inputs:
+        try:
+            results = EDITIONS[name].build(wiki, output_path, **options)
+        except Exception as exc:
+            log.exception('Failed to build edition: {}'.format(name))
+            error = ': '.join(i for i in (type(exc).__name__, str(exc)) if i)
+    filenames = list(results)
+    written = [f for f in filenames if results[f].written]
+    fallbacks = [i for f in filenames for i in results[f].fallbacks]
+    size = sum(os.path.getsize(f) for f in filenames)
+    return Summary(
+        name, time.time() - started, size, filenames, written, fallbacks,
+        inputs, utils.peak_memory(), error)
+
+
+def build(names, wikis, output_path, workers=None, **options):
+    """
+    Build the named editions concurrently.
+
+    The wikis argument maps site names to wiki objects. Each wiki is wrapped
+    in a single CachedWiki, which is then shared by all editions of the site.
+    Any options are passed on to the build functions.
+    Returns a list of summaries, in the same order as the names. An edition
+    failing to build doesn't stop the others; its error is reported in its
+    summary instead.
+    """
+    shared = {}
+    for name in names:
+        site = EDITIONS[name].site
+        if site not in shared:
+            wiki = wikis[site]
+            if not isinstance(wiki, cache.CachedWiki):
+                wiki = cache.CachedWiki(wiki)
+            shared[site] = wiki
+    with concurrent.futures.ThreadPoolExecutor(
+            workers or len(names)) as executor:
+        futures = [
+            executor.submit(
+                _build_edition, name, shared[EDITIONS[name].site],
+                output_path, options)
+            for name in names]
+        return [f.result() for f in futures]
+
+
+def print_summary(summaries):
+    for s in summaries:
+        minutes, seconds = divmod(round(s.seconds), 60)
+        if s.error:
+            print('{:20} failed ({:02}:{:02}): {}'.format(
+                s.name, minutes, seconds, s.error))
+            continue
+        print(
+            '{:20} {:>4} file(s) {:>4} written {:>10.1f} MiB ({:02}:{:02}) '
+            'process peak memory {:.1f} MiB'.format(
+                s.name, len(s.filenames), len(s.written), s.size / 2 ** 20,
+                minutes, seconds, s.peak / 2 ** 20))
+        for url, reason in s.fallbacks:
+            print('    rendered as plain text: {} ({})'.format(url, reason))
+
+###############################################################################
+
+
+def main():
+    import pyscp.wikidot
+    cli = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    cli.add_argument('output_path')
+    cli.add_argument(
+        'editions', nargs='*', default=list(EDITIONS),
+        help='one or more of: ' + ', '.join(EDITIONS))
+    cli.add_argument(
+        '--cache', help='directory for the persistent listing cache')
+    cli.add_argument('--ttl', type=int, default=3600)
+    cli.add_argument('--refresh', action='store_true')
+    cli.add_argument('--workers', type=int)
+    cli.add_argument(
+        '--max-pages', type=int,
+        help='maximum number of pages kept in memory; also streams the '
+        'images of the complete collection')
+    cli.add_argument(
+        '--page-timeout', type=int,
+        help='render each page in an isolated worker, within this many '
+        'seconds')
+    cli.add_argument(
+        '--page-memory', type=int,
+        help='memory budget of the page worker, in MiB; requires '
+        '--page-timeout')
+    cli.add_argument(
+        '--images', help='directory of the persistent image store')
+    cli.add_argument(
+        '--images-size', type=int, default=1024,
+        help='maximum size of the image store, in MiB')
+    cli.add_argument(
+        '--reproducible', action='store_true',
+        help='write byte-for-byte reproducible books, leaving unchanged '
+        'ones untouched')
+    args = cli.parse_args()
+    for name in args.editions:
+        if name not in EDITIONS:
+            cli.error('unknown edition: {}'.format(name))
+    if args.page_memory and not args.page_timeout:
+        cli.error('--page-memory requires --page-timeout')
+    wikis = {}
+    for site in {EDITIONS[n].site for n in args.editions}:
+        path = args.cache and os.path.join(args.cache, site)
+        wikis[site] = cache.CachedWiki(
+            pyscp.wikidot.Wiki(site), path,
+            ttl=args.ttl, refresh=args.refresh, max_pages=args.max_pages)
+    options = {}
+    if args.max_pages:
+        options['max_pages'] = args.max_pages
+    if args.page_timeout:
+        options['page_timeout'] = args.page_timeout
+    if args.page_memory:
+        options['page_memory'] = args.page_memory * 2 ** 20
+    if args.reproducible:
+        options['reproducible'] = True
+    if args.images:
+        options['image_store'] = cache.ImageStore(
+            args.images, args.images_size * 2 ** 20)
+    print_summary(build(
+        args.editions, wikis, args.output_path, args.workers, **options))
+
+
+if __name__ == '__main__':
+    main()
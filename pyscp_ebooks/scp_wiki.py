@@ -4,19 +4,20 @@
 # Module Imports
 ###############################################################################
 
-import arrow
+import collections
 import itertools
-import functools
 import pkgutil
 import re
 
-from . import builder, parser
+from . import builder, cache, parser
 
 ###############################################################################
 
 
 class Parser(parser.Parser):
 
+    attributes = parser.Parser.attributes + ('tags',)
+
     def __init__(self, pages, images):
         super().__init__(pages)
         self.images = images
@@ -54,8 +55,11 @@ class Book(builder.Book):
     analogous api done via functions.
     """
 
-    def __init__(self, wiki, heap, cover, **kwargs):
+    def __init__(self, wiki, heap, cover, stream_images=False,
+                 image_store=None, **kwargs):
         super().__init__(wiki, heap, author='Various Authors', **kwargs)
+        self.stream_images = stream_images
+        self.image_store = image_store
         self.book.set_cover(pkgutil.get_data(
             'pyscp_ebooks', 'resources/scp_wiki/' + cover))
         self.book.set_stylesheet(pkgutil.get_data(
@@ -65,18 +69,18 @@ class Book(builder.Book):
             i.url: i for i in self.wiki.list_images()
             if i.status in ('BY-SA CC', 'PUBLIC DOMAIN')}
         self.used_images = []
+        self._tag_cache = {}
 
-    def _get_content(self, page):
-        if not hasattr(self, '_parser'):
-            self._parser = Parser(self.urls, self.whitelisted_images.keys())
-        return self._parser.parse(page)
+    def _get_parser(self):
+        return Parser(None, set(self.whitelisted_images))
 
     ###########################################################################
 
     def add_url(self, url, parent=None):
         page = super().add_url(url, parent)
         self.used_images.extend(
-            i for i in self.wiki(url).images if i in self.whitelisted_images)
+            i for i in self.documents.images(url)
+            if i in self.whitelisted_images)
         for i in self._get_children(url):
             self.add_url(i, page)
         return page
@@ -97,16 +101,16 @@ class Book(builder.Book):
             return []
 
     def _children_skip(self, url):
-        return [u for u in self.wiki(url).links
+        return [u for u in self.documents.links(url)
                 if u in self._tags('supplement splash')]
 
     def _children_hub(self, url):
         candidates = [
-            i for i in self.wiki(url).links if i in
+            i for i in self.documents.links(url) if i in
             self._tags('tale goi-format goi2014 -hub')]
         confirmed = [
             i for i in candidates
-            if url in self.wiki(i).links or url == self.wiki(i).parent]
+            if url in self.documents.links(i) or url == self.wiki(i).parent]
         return confirmed if confirmed else candidates
 
     ###########################################################################
@@ -116,7 +120,8 @@ class Book(builder.Book):
         source = []
         template = ('<p>The image {} is licensed under {} '
                     'and available at <u>{}</u>.</p>')
-        for url in self.used_images:
+        # pages can share an image, and use it more than once
+        for url in collections.OrderedDict.fromkeys(self.used_images):
             name = '{}_{}'.format(*url.split('/')[-2:])
             image = self.whitelisted_images[url]
             source.append(template.format(name, image.status, image.source))
@@ -127,10 +132,15 @@ class Book(builder.Book):
 
     ###########################################################################
 
-    @functools.lru_cache()
     def _tags(self, tags):
         """Return a set of urls with matching tags."""
-        tags = tags.split()
+        # cached per book rather than with lru_cache, which would keep past
+        # books alive in long-running processes
+        if tags not in self._tag_cache:
+            self._tag_cache[tags] = self._find_tags(tags.split())
+        return self._tag_cache[tags]
+
+    def _find_tags(self, tags):
         result = set()
         for t in [t for t in tags if t[0] not in '+-']:
             result |= {p.url for p in self.wiki.list_pages(tag=t)}
@@ -147,9 +157,7 @@ class Book(builder.Book):
             'resources/scp_wiki/{}.xhtml'.format(x)).decode('UTF-8')
         self.add_page('Cover Page', page('cover'))
         self.add_page('Introduction', page('intro'))
-        license = parser.bs(page('license'))
-        license.find(class_='footer').string = arrow.now().format('YYYY-MM-DD')
-        self.add_page('License', license.div.prettify())
+        self.add_license(page('license'))
         self.add_page('Title Page', page('title'))
 
     def _add_skip_block(self, block_number, parent=None):
@@ -165,10 +173,11 @@ class Book(builder.Book):
 
     def _add_misc_skips(self, parent=None):
         """Add 001 proposals, jokes, and explained articles."""
-        self.new_section('001 Proposals', self.wiki('scp-001').links, parent)
-        self.new_section('Joke Articles', self._tags('joke'), parent)
         self.new_section(
-            'Explained Phenomena', self._tags('explained'), parent)
+            '001 Proposals', self.documents.links('scp-001'), parent)
+        self.new_section('Joke Articles', sorted(self._tags('joke')), parent)
+        self.new_section(
+            'Explained Phenomena', sorted(self._tags('explained')), parent)
 
     def add_skips(self, start=0, end=30, misc=False):
         section = self.new_section('SCP Database')
@@ -203,32 +212,67 @@ class Book(builder.Book):
     ###########################################################################
 
     def save(self, filename):
-        for i in self.used_images:
-            self.book.add_image(
-                '{}_{}'.format(*i.split('/')[-2:]),
-                self.whitelisted_images[i].data)
-        super().save(filename)
+        """
+        Add the used images and save the book.
+
+        When streaming, the image data is copied straight into the book and
+        is never held in memory. With an image store, images are only
+        downloaded if they aren't stored yet, always streaming them into the
+        store, and are then linked into the book from it. Both require image
+        objects with an open() method, such as those returned by
+        cache.CachedWiki.
+        """
+        for i in collections.OrderedDict.fromkeys(self.used_images):
+            image = self.whitelisted_images[i]
+            if self.image_store:
+                data = self.image_store.get(i, image.open)
+            elif self.stream_images:
+                data = image.open()
+            else:
+                data = image.data
+            self.book.add_image('{}_{}'.format(*i.split('/')[-2:]), data)
+        return super().save(filename)
 
 ###############################################################################
 
 
-def build_complete(wiki, output_path):
+def build_complete(wiki, output_path, max_pages=None, **kwargs):
+    """
+    Create the Complete Collection ebook.
+
+    If max_pages is given, the build runs in bounded memory mode: at most
+    max_pages page objects and parsed pages are kept in memory at once, and
+    image data is streamed into the book instead of being loaded. A
+    CachedWiki passed in keeps its own max_pages, since it may be shared
+    with other builds; any other wiki is wrapped in a CachedWiki with the
+    limit.
+
+    Any other keyword arguments are passed on to the Book, as they are in
+    the other build functions. Like them, returns an ordered mapping of the
+    filenames of the books to the builder.Saved results of saving them.
+    """
+    if max_pages and not isinstance(wiki, cache.CachedWiki):
+        wiki = cache.CachedWiki(wiki, max_pages=max_pages)
     book = Book(
         wiki, wiki.list_pages(rating='>0'), 'scp_cover_1.png',
-        title='SCP Foundation: The Complete Collection')
+        stream_images=bool(max_pages), max_pages=max_pages,
+        title='SCP Foundation: The Complete Collection', **kwargs)
     book.add_intro()
     book.add_skips(misc=True)
     book.add_hubs()
     book.add_tales()
     book.add_credits()
-    book.save(output_path + book.book.title.replace(':', ' -') + '.epub')
+    filename = output_path + book.book.title.replace(':', ' -') + '.epub'
+    return collections.OrderedDict([(filename, book.save(filename))])
 
 
-def build_tomes(wiki, output_path):
+def build_tomes(wiki, output_path, **kwargs):
     heap = list(wiki.list_pages(rating='>0'))
+    filenames = collections.OrderedDict()
     for tome in range(12):
         book = Book(wiki, heap, 'scp_cover_2.png',
-                    title='SCP Foundation: Tome {}'.format(tome + 1))
+                    title='SCP Foundation: Tome {}'.format(tome + 1),
+                    **kwargs)
         book.add_intro()
         if tome < 6:
             book.add_skips(tome * 5, tome * 5 + 5, misc=tome == 5)
@@ -237,21 +281,31 @@ def build_tomes(wiki, output_path):
         else:
             book.add_tales(*('0D', 'EL', 'MS', 'TZ')[tome - 8])
         book.add_credits()
-        book.save(output_path + book.book.title.replace(':', ' -') + '.epub')
+        filename = (
+            output_path + book.book.title.replace(':', ' -') + '.epub')
+        filenames[filename] = book.save(filename)
+    return filenames
+
+
+def digest_month():
+    """Return the month covered by the Monthly Digest."""
+    import arrow
+    return arrow.now().replace(months=-1)
 
 
-def build_digest(wiki, output_path):
+def build_digest(wiki, output_path, **kwargs):
     """Create Monthly Digest ebook."""
-    date = arrow.now().replace(months=-1)
+    date = digest_month()
     short_date = date.format('YYYY-MM')
     long_date = date.format('MMMM YYYY')
     book = Book(
         wiki, wiki.list_pages(rating='>0', created=short_date),
-        'scp_cover_3.png',
-        title='SCP Foundation Monthly Digest: ' + long_date)
+        'scp_cover_3.png', date=date.floor('month'),
+        title='SCP Foundation Monthly Digest: ' + long_date, **kwargs)
     book.add_intro()
     book.add_skips(misc=True)
     # hubs are intentionally not included
     book.add_tales()
     book.add_credits()
-    book.save(output_path + book.book.title.replace(':', ' -') + '.epub')
+    filename = output_path + book.book.title.replace(':', ' -') + '.epub'
+    return collections.OrderedDict([(filename, book.save(filename))])
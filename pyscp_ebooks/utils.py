@@ -4,19 +4,28 @@
 # Module Imports
 ###############################################################################
 
-import arrow
 import os
+import resource
+import sys
+import time
 
 ###############################################################################
 
 
+def peak_memory():
+    """Return the peak resident set size of the process, in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macos reports bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
 class PBar:
 
     def __init__(self, text, max_value):
         self.text = text
         self.max_value = max_value
         self.value = 0
-        self.started = arrow.now()
+        self.started = time.time()
         self.width = 40
         os.system('setterm -cursor off')
         print(self._line() + '\r', end='')
@@ -29,7 +38,7 @@ class PBar:
         percentage = round(100 * self.value / self.max_value)
         filled = round(self.width * self.value / self.max_value)
         empty = self.width - filled
-        minutes, seconds = divmod((arrow.now() - self.started).seconds, 60)
+        minutes, seconds = divmod(int(time.time() - self.started), 60)
         return '{} |{}{}| {:>3}% ({:02}:{:02})'.format(
             self.text, '█' * filled, ' ' * empty, percentage, minutes, seconds)
 
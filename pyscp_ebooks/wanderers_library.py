@@ -4,11 +4,12 @@
 # Module Imports
 ###############################################################################
 
+import collections
+import concurrent.futures
 import pkgutil
 import re
-import arrow
 
-from . import builder, parser
+from . import builder, cache, parser
 
 ###############################################################################
 
@@ -31,29 +32,102 @@ class Book(builder.Book):
             'resources/wanderers_library/{}.xhtml'.format(x)).decode('UTF-8')
         self.add_page('Cover Page', page('cover'))
         self.add_page('Introduction', page('intro'))
-        license = parser.bs(page('license'))
-        license.find(class_='footer').string = arrow.now().format('YYYY-MM-DD')
-        self.add_page('License', license.div.prettify())
+        self.add_license(page('license'))
         self.add_page('Title Page', page('title'))
 
-    def add_library(self):
-        """Add library books to the ebook."""
-        library = self.new_section('The Library')
-        books = self.wiki('the-library')._soup(class_='boxbook')
-        template = (
-            '<div class="book-title">{}</div>'
-            '<div class="book-description">{}</div>')
+    def prefetch(self, workers=16):
+        """
+        Load the pages needed to build the book structure.
+
+        Fetches the index pages and then every excerpt linked from them
+        concurrently, so that the add_* methods don't have to wait on a long
+        chain of serial requests. The wiki is wrapped in a CachedWiki if it
+        isn't one already, so that the loaded page objects are reused.
+        """
+        if not isinstance(self.wiki, cache.CachedWiki):
+            self.wiki = self.documents.wiki = cache.CachedWiki(self.wiki)
+        indexes = [
+            'the-library', 'the-archives', 'prompt-archive',
+            'thearchivistslog']
+        self._load(indexes, indexes, workers)
+        urls = [e for t, d, ex in self._library_books(False) for e in ex]
+        urls += self.documents.links('the-archives')
+        urls += [u for t, d, links in self._prompts() for u in links]
+        urls += [u for b in self._goi_blocks() for u in self._goi_links(b)]
+        # the journal of aframos longjourney lists its excerpts on a
+        # separate index page, so they can only be found once it's loaded
+        indexes = self._aframos_indexes()
+        self._load(set(urls) & self.heap | set(indexes), indexes, workers)
+        urls = [e for t, d, ex in self._library_books() for e in ex]
+        self._load(set(urls) & self.heap, [], workers)
+
+    def _load(self, urls, indexes, workers):
+        """
+        Concurrently fetch the pages, parsing those that are indexes.
+
+        The pages are recorded as inputs of the build (see CachedWiki.record)
+        even though they are fetched by other threads.
+        """
+        load = lambda x: (
+            self.documents(x) if x in indexes else self.wiki(x).html)
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            list(executor.map(self.wiki.bind(load), urls))
+
+    ###########################################################################
+
+    def _library_books(self, expand=True):
+        """
+        Yield the title, description, and excerpt urls of each library book.
+
+        If expand is False, the excerpts of the Aframos journal aren't
+        replaced by the links from its index page.
+        """
+        books = self.documents('the-library')(class_='boxbook')
         for b in books:
             title = b.find(class_='booktitle').string
             description = b.find(class_='boxleft')('div')[0].text.strip()
             excerpts = [self.wiki.site + a['href']
                         for a in b.find(class_='boxright')('a')]
-            if title == 'The Journal of Aframos Longjourney':
-                links = self.wiki(excerpts[1])._soup.select('#page-content a')
+            if expand and title == 'The Journal of Aframos Longjourney':
+                links = self.documents(excerpts[1]).select('#page-content a')
                 links = [
                     'http://wanderers-library.wikidot.com/' +
                     l['href'].split('/')[-1] for l in links]
                 excerpts = [excerpts[0]] + links
+            yield title, description, excerpts
+
+    def _aframos_indexes(self):
+        return [
+            excerpts[1] for title, d, excerpts in self._library_books(False)
+            if title == 'The Journal of Aframos Longjourney']
+
+    def _prompts(self):
+        """Yield the title, description, and urls of each writing prompt."""
+        titles = ('Wanderlust', 'Space Witch', 'Relationship')
+        prompts = self.documents('prompt-archive').find(
+            id='page-content')('div', recursive=False)
+        for title, prompt in zip(titles, prompts):
+            description = prompt.find('blockquote').text
+            links = [self.wiki.site + a['href'] for a in prompt('a')]
+            yield title, description, links
+
+    def _goi_blocks(self):
+        goi_page = self.documents('thearchivistslog').find(id='page-content')
+        return goi_page(
+            'div', style=re.compile('background[^;]*#f2f2c2'))
+
+    def _goi_links(self, soup):
+        return [self.wiki.site + a['href'] for a in soup('a')]
+
+    ###########################################################################
+
+    def add_library(self):
+        """Add library books to the ebook."""
+        library = self.new_section('The Library')
+        template = (
+            '<div class="book-title">{}</div>'
+            '<div class="book-description">{}</div>')
+        for title, description, excerpts in self._library_books():
             book = self.add_page(
                 title, template.format(title, description), library)
             for url in excerpts:
@@ -61,19 +135,14 @@ class Book(builder.Book):
 
     def add_archives(self):
         self.new_section(
-            'The Archives', sorted(self.wiki('the-archives').links))
+            'The Archives', sorted(self.documents.links('the-archives')))
 
     def add_prompts(self):
         main_section = self.new_section('Writing Prompts')
-        titles = ('Wanderlust', 'Space Witch', 'Relationship')
-        prompts = self.wiki('prompt-archive')._soup.find(
-            id='page-content')('div', recursive=False)
         template = (
             '<div class="book-title">{}</div>'
             '<div class="book-description">{}</div>')
-        for title, prompt in zip(titles, prompts):
-            description = prompt.find('blockquote').text
-            links = [self.wiki.site + a['href'] for a in prompt('a')]
+        for title, description, links in self._prompts():
             subsection = self.add_page(
                 title, template.format(title, description), main_section)
             for url in links:
@@ -94,24 +163,26 @@ class Book(builder.Book):
             a.name = 'span'
             a.attrs = {'class': 'link'}
         goi_page = self.add_page(title, source.prettify(), parent)
-        for url in [self.wiki.site + a['href'] for a in soup('a')]:
+        for url in self._goi_links(soup):
             self.add_url(url, goi_page)
 
     def add_goi(self):
-        goi_page = self.wiki('thearchivistslog')._soup.find(id='page-content')
+        goi_page = self.documents('thearchivistslog').find(id='page-content')
         title = goi_page.div('p')[0].text
         section = self.new_section(title)
-        for block in goi_page(
-                'div', style=re.compile('background[^;]*#f2f2c2')):
+        for block in self._goi_blocks():
             self._add_goi_page(block, section)
 
 
-def build_complete(wiki, output_path):
-    book = Book(wiki, wiki.list_pages(), title="Wanderers' Library")
+def build_complete(wiki, output_path, **kwargs):
+    book = Book(
+        wiki, wiki.list_pages(), title="Wanderers' Library", **kwargs)
+    book.prefetch()
     book.add_intro()
     book.add_library()
     book.add_archives()
     book.add_prompts()
     book.add_goi()
     book.add_credits()
-    book.save(output_path + book.book.title.replace(':', ' -') + '.epub')
+    filename = output_path + book.book.title.replace(':', ' -') + '.epub'
+    return collections.OrderedDict([(filename, book.save(filename))])
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Render pages in an isolated worker process.
+
+A few pathological pages, such as ones with deeply nested collapsibles or
+enormous tables, can take minutes to parse. The Watchdog renders each page
+in a separate process under a time and memory budget. If the budget is
+exceeded, the worker is killed and the page is rendered as plain text
+instead, so that no single page can stall a whole build.
+"""
+
+###############################################################################
+# Module Imports
+###############################################################################
+
+import html
+import html.parser
+import logging
+import multiprocessing
+import os
+import resource
+import types
+
+from . import epub
+
+###############################################################################
+
+log = logging.getLogger(__name__)
+
+###############################################################################
+
+
+class Snapshot:
+
+    """
+    Picklable copy of a wiki page.
+
+    Holds the given attributes of the page, and the site of its wiki, which
+    is all the parsers need to render it.
+    """
+
+    def __init__(self, page, attributes):
+        for name in attributes:
+            setattr(self, name, getattr(page, name))
+        self._wiki = types.SimpleNamespace(site=page._wiki.site)
+
+
+class _TextExtractor(html.parser.HTMLParser):
+
+    """Collect the paragraphs of text inside the page content."""
+
+    BLOCKS = {
+        'p', 'div', 'br', 'li', 'tr', 'blockquote', 'table', 'hr',
+        'h1', 'h2', 'h3', 'h4', 'h5', 'h6'}
+    VOID = {
+        'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input',
+        'link', 'meta', 'param', 'source', 'track', 'wbr'}
+
+    def __init__(self):
+        super().__init__()
+        self.depth = 0
+        self.paragraphs = ['']
+
+    def handle_starttag(self, tag, attrs):
+        if self.depth:
+            if tag not in self.VOID:
+                self.depth += 1
+            if tag in self.BLOCKS:
+                self.paragraphs.append('')
+        elif dict(attrs).get('id') == 'page-content':
+            self.depth = 1
+
+    def handle_endtag(self, tag):
+        if self.depth and tag not in self.VOID:
+            self.depth -= 1
+            if tag in self.BLOCKS:
+                self.paragraphs.append('')
+
+    def handle_data(self, data):
+        if self.depth:
+            self.paragraphs[-1] += data
+
+
+def fallback(page):
+    """Render the text of the page, without any of its markup."""
+    extractor = _TextExtractor()
+    extractor.feed(page.html)
+    extractor.close()
+    paragraphs = (' '.join(p.split()) for p in extractor.paragraphs)
+    return '<div><p class="title">{}</p>{}</div>'.format(
+        html.escape(page.title),
+        ''.join('<p>{}</p>'.format(html.escape(p)) for p in paragraphs if p))
+
+###############################################################################
+
+_parser = None
+
+
+def _init(parser, memory):
+    global _parser
+    _parser = parser
+    if memory:
+        # the budget is counted on top of what the worker already uses once
+        # it has started and imported the parser
+        try:
+            with open('/proc/self/statm') as file:
+                used = int(file.read().split()[0]) * os.sysconf('SC_PAGESIZE')
+        except OSError:
+            used = 0
+        resource.setrlimit(resource.RLIMIT_AS, (used + memory, used + memory))
+
+
+def _render(page):
+    return epub.render_page(page.title, _parser.parse(page))
+
+
+class Watchdog:
+
+    """
+    Render pages with a parser in an isolated worker process.
+
+    Each page must be rendered within timeout seconds, and the worker may
+    use at most memory additional bytes. Pages exceeding the budget, or
+    failing to render for any other reason, are rendered with fallback,
+    and listed in the failed attribute together with the reason.
+
+    Builds run in threads, and forking a multi-threaded process can leave
+    locks held in the child, so the worker is started from a forkserver
+    where available, and spawned otherwise. The parser must be picklable.
+    """
+
+    def __init__(self, parser, timeout, memory=None):
+        self.parser = parser
+        self.timeout = timeout
+        self.memory = memory
+        self.failed = []
+        self._pool = None
+
+    def render(self, page):
+        """Return the rendered xhtml of the page."""
+        snapshot = Snapshot(page, self.parser.attributes)
+        if self._pool is None:
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context(
+                'forkserver' if 'forkserver' in methods else 'spawn')
+            self._pool = context.Pool(1, _init, (self.parser, self.memory))
+        result = self._pool.apply_async(_render, (snapshot,))
+        try:
+            return result.get(self.timeout)
+        except multiprocessing.TimeoutError:
+            # the worker can't be interrupted, only replaced
+            self.close()
+            reason = 'timed out after {}s'.format(self.timeout)
+        except Exception as error:
+            reason = ': '.join(
+                i for i in (type(error).__name__, str(error)) if i)
+        log.warning('Fallback rendering for {}: {}'.format(page.url, reason))
+        self.failed.append((page.url, reason))
+        return epub.render_page(snapshot.title, fallback(snapshot))
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None